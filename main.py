@@ -1,37 +1,92 @@
 from typing import Optional, List
 from typing import Annotated
-from datetime import datetime, time, timedelta
+from datetime import datetime, time, timedelta, timezone
+from contextlib import asynccontextmanager
+import os
 
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 
 
 from datetime import time
-from fastapi import FastAPI, HTTPException, Depends, Query, Body
-from sqlmodel import SQLModel, Field, Session, create_engine, select, delete
+from fastapi import FastAPI, HTTPException, Depends, Query, Body, Header
+from fastapi.responses import ORJSONResponse, Response
+from sqlmodel import SQLModel, Field, select, delete
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy import Boolean, Column, Computed, DateTime, Index, Integer, bindparam, event, func, text, tuple_, update
+from sqlalchemy.orm import raiseload
 from typing import List, Dict
-from pydantic import BaseModel
-import json
-from dateutil import parser
+from pydantic import BaseModel, ConfigDict
+from enum import IntEnum
+from uuid import uuid4
 import httpx
+import orjson
+from cachetools import TTLCache
 ADAFRUIT_FEED_URLS = {
     1:  "https://io.adafruit.com/api/v2/webhooks/feed/hDxXDFEQ581nYMaygY2nHRMN9nXm",
     2:  "https://io.adafruit.com/api/v2/webhooks/feed/CfAs3xJMCTNSgTENkrnZgQok8cg2",
     3:  "https://io.adafruit.com/api/v2/webhooks/feed/8ethcgUgXJ6CxZh3Bx5SSYihoNnG" 
 }
+FEED_TO_COMPARTMENT = {
+    "comp1-taken": 1,
+    "comp2-taken": 2,
+    "comp3-taken": 3
+}
+
+# A compartment is low on stock below this many pills
+LOW_STOCK_THRESHOLD = 4
+
+
+# Path parameter type: pydantic rejects anything but 1, 2 or 3 before the
+# handler runs, and it shows up as an enum in the OpenAPI schema
+class CompartmentNum(IntEnum):
+    ONE = 1
+    TWO = 2
+    THREE = 3
+
 
 # Database Configuration
 sqlite_file_name = "medicine_db.db"
-sqlite_url = f"sqlite:///{sqlite_file_name}"
+sqlite_url = f"sqlite+aiosqlite:///{sqlite_file_name}"
+
+# Keep a persistent pool of open connections so webhook bursts don't pay
+# the SQLite file open cost on every request. SQLite only has one writer at a
+# time anyway, so the pool is sized to the worker's cores (cores * 2 + 1)
+# rather than left to grow with overflow connections.
+pool_size = (os.cpu_count() or 1) * 2 + 1
+engine = create_async_engine(
+    sqlite_url,
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=pool_size,
+    max_overflow=0,
+    pool_timeout=30,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    query_cache_size=1200,  # room for every statement variant compiled by the app
+)
+AsyncSessionLocal = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
 
-connect_args = {"check_same_thread": False}
-engine = create_engine(sqlite_url, connect_args=connect_args)
+@event.listens_for(engine.sync_engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    # WAL lets the read endpoints keep going while the webhook writes
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
 
 
 # Model Definition
 class CompartmentBase(SQLModel):
-    compartment_number: int = Field(index=True)  # 1, 2, or 3
+    compartment_number: int = Field(ge=1, le=3)
 
-    medicine_name: str = Field(index=True)
+    medicine_name: str
     number_of_medicines: int = Field(default=0)
     to_be_repeated: bool = Field(default=False)
 
@@ -45,10 +100,22 @@ class CompartmentBase(SQLModel):
 
     taken : bool= Field(default=False)
     taken_at : Optional[datetime] = None
-    low_stock: bool = Field(default=False)
 
 class Compartment(CompartmentBase, table=True):
+    __table_args__ = (
+        Index("ix_compartment_number_taken", "compartment_number", "taken"),
+        Index("ix_compartment_number_medicine_name", "compartment_number", "medicine_name"),
+    )
+    # Read back server-generated columns (low_stock) in the INSERT/UPDATE
+    # itself, so they are never lazy loaded after a commit
+    __mapper_args__ = {"eager_defaults": True}
+
     id: Optional[int] = Field(default=None, primary_key=True)
+    # Generated by SQLite from number_of_medicines, never written by the app
+    low_stock: Optional[bool] = Field(
+        default=None,
+        sa_column=Column(Boolean, Computed(f"number_of_medicines < {LOW_STOCK_THRESHOLD}", persisted=False)),
+    )
 
 
 class CompartmentCreate(CompartmentBase):
@@ -70,14 +137,16 @@ class CompartmentUpdate(SQLModel):
 
 class CompartmentPublic(CompartmentBase):
     id: int
+    low_stock: bool
 
 class AdafruitData(BaseModel):
+    # Only what the webhook reads; feed_key, updated_at, expiration etc.
+    # are dropped without being validated
+    model_config = ConfigDict(extra="ignore")
+
     value: str
     feed_name: str
-    feed_key: str
-    created_at: str
-    updated_at: str
-    expiration: int
+    created_at: datetime
 
 class RefillRequest(BaseModel):
     amount: int
@@ -86,23 +155,232 @@ class MedicineLog(SQLModel, table= True):
     id: Optional[int] = Field(default=None, primary_key=True)
     compartment_number: int
     medicine_name: str
-    taken_at: datetime
+    taken_at: datetime = Field(index=True)  # ordered by /logs/, range-scanned by /logs/by-day/
     action: str = Field(default="taken")  # can be "taken", "refill", "manual"
 
 
 
-def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
+# Statements reused by the hot endpoints, built once at import time and
+# bound per request. The ones returning ORM entities (not column rows) carry
+# raiseload("*"), so a relationship added later without an explicit
+# selectinload() fails loudly instead of lazy loading one query per row.
 
+# The list endpoints read plain column rows instead of ORM objects and
+# serialize them straight to JSON, skipping per-row model validation. Rows
+# come back by id, so the first one listed for a compartment is the one the
+# webhook, refill and mark/unmark endpoints act on.
+_compartment_rows = select(*Compartment.__table__.columns).order_by(Compartment.id)
+_rows_by_num = _compartment_rows.where(Compartment.compartment_number == bindparam("n"))
+_rows_taken = _compartment_rows.where(
+    (Compartment.compartment_number == bindparam("n")) &
+    (Compartment.taken == True)
+)
+_rows_pending = _compartment_rows.where(
+    (Compartment.compartment_number == bindparam("n")) &
+    (Compartment.taken == False)
+)
 
-def get_session():
-    with Session(engine) as session:
+# Logs are paged by (taken_at, id) rather than by offset, which the taken_at
+# index serves directly since it carries the rowid. The id breaks ties between
+# logs of one webhook batch, which share a timestamp.
+_log_rows = (
+    select(*MedicineLog.__table__.columns)
+    .order_by(MedicineLog.taken_at.desc(), MedicineLog.id.desc())
+    .limit(bindparam("limit"))
+)
+_log_rows_before = _log_rows.where(MedicineLog.taken_at < bindparam("before"))
+_log_rows_before_id = _log_rows.where(
+    tuple_(MedicineLog.taken_at, MedicineLog.id)
+    < tuple_(bindparam("before", type_=DateTime), bindparam("before_id", type_=Integer))
+)
+_stmt_logs_between = select(MedicineLog).options(raiseload("*")).where(
+    MedicineLog.taken_at >= bindparam("start"),
+    MedicineLog.taken_at < bindparam("end")
+).order_by(MedicineLog.taken_at).limit(bindparam("limit"))
+
+# A compartment can hold several medicines; the single-row endpoints act on
+# the first one by id
+_first_id_by_num = (
+    select(Compartment.id)
+    .where(Compartment.compartment_number == bindparam("n"))
+    .order_by(Compartment.id)
+    .limit(1)
+    .scalar_subquery()
+)
+_stmt_mark_taken = (
+    update(Compartment)
+    .where(Compartment.id == _first_id_by_num)
+    .values(taken=True, taken_at=bindparam("now"))
+    .returning(Compartment)
+    .options(raiseload("*"))
+)
+_stmt_unmark_taken = (
+    update(Compartment)
+    .where(Compartment.id == _first_id_by_num)
+    .values(taken=False, taken_at=None)
+    .returning(Compartment)
+    .options(raiseload("*"))
+)
+_stmt_refill = (
+    update(Compartment)
+    .where(Compartment.id == _first_id_by_num)
+    .values(number_of_medicines=Compartment.number_of_medicines + bindparam("amount"), taken=False)
+    .returning(Compartment.number_of_medicines)
+)
+# The webhook decrements in SQL rather than writing back a count read
+# earlier, so overlapping deliveries for one compartment can't lose pills
+_stmt_take_pill = (
+    update(Compartment)
+    .where(Compartment.id == bindparam("comp_id"))
+    .values(
+        number_of_medicines=func.max(Compartment.number_of_medicines - 1, 0),  # prevent negatives
+        taken=True,
+        taken_at=bindparam("ts"),
+    )
+    .returning(
+        Compartment.compartment_number,
+        Compartment.medicine_name,
+        Compartment.number_of_medicines,
+        Compartment.low_stock,
+    )
+)
+_stmt_delete_by_num_and_name = delete(Compartment).where(
+    (Compartment.compartment_number == bindparam("n")) &
+    (Compartment.medicine_name == bindparam("name"))
+)
+
+
+# Id of the first compartment row by compartment_number, so the webhook can
+# skip the lookup SELECT. Only ids are kept, never column values: those are
+# always read and written in SQL. Any write outside the webhook clears it and
+# it's lazily refilled. This assumes a single process owns the database; rows
+# deleted by another worker or by hand are only noticed when the webhook's
+# UPDATE misses, which drops the entry and looks the compartment up again.
+_compartment_cache: Dict[int, int] = {}
+
+# Bumped on every write to the compartment table (and by the webhook, the only
+# writer of medicine logs) and used as the ETag of the list endpoints. The boot
+# id keeps tags from a previous process from matching.
+_compartments_version = 0
+_compartments_boot_id = uuid4().hex[:8]
+
+# Rendered JSON of the hot GET endpoints, for dashboards polling them. Keys
+# start with the version above, so a write makes older entries unreachable
+# and the TTL evicts them.
+_response_cache = TTLCache(maxsize=128, ttl=10)
+
+
+def bump_compartments_version():
+    global _compartments_version
+    _compartments_version += 1
+
+
+def invalidate_compartment_cache():
+    _compartment_cache.clear()
+    bump_compartments_version()
+
+
+async def load_compartment_cache(session: AsyncSession, numbers=None) -> Dict[int, int]:
+    stmt = select(Compartment.compartment_number, Compartment.id).order_by(Compartment.id)
+    if numbers is not None:
+        stmt = stmt.where(Compartment.compartment_number.in_(numbers))
+    version = _compartments_version
+    ids = {}
+    for compartment_number, compartment_id in (await session.exec(stmt)).all():
+        ids.setdefault(compartment_number, compartment_id)
+    # Another request may have invalidated the cache while the SELECT ran,
+    # don't put back ids that could already be stale
+    if version == _compartments_version:
+        for compartment_number, compartment_id in ids.items():
+            _compartment_cache.setdefault(compartment_number, compartment_id)
+    return ids
+
+
+async def render_rows(session: AsyncSession, stmt, params=None) -> bytes:
+    result = await session.exec(stmt, params=params)
+    return orjson.dumps([dict(row) for row in result.mappings()])
+
+
+async def cached_rows_response(session: AsyncSession, key: tuple, stmt, params=None, etag: Optional[str] = None) -> Response:
+    key = (_compartments_version, *key)
+    body = _response_cache.get(key)
+    if body is None:
+        body = await render_rows(session, stmt, params)
+        _response_cache[key] = body
+    headers = {"ETag": etag} if etag else None
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def create_missing_indexes(connection):
+    # create_all skips tables that already exist, so indexes added later
+    # would never reach an existing database file
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
+def drop_replaced_indexes(connection):
+    # create_all never drops anything, so indexes removed from the models
+    # would linger on existing database files
+    for name in (
+        "ix_compartment_compartment_number",  # leading column of ix_compartment_number_taken
+        "ix_compartment_medicine_name",  # only ever queried with compartment_number
+    ):
+        connection.execute(text(f"DROP INDEX IF EXISTS {name}"))
+
+
+def migrate_low_stock_column(connection):
+    # Databases created before low_stock became a generated column store it
+    # as a plain one; swap it for the virtual column in place
+    columns = connection.execute(text("PRAGMA table_xinfo(compartment)")).mappings().all()
+    if any(col["name"] == "low_stock" and col["hidden"] == 0 for col in columns):
+        connection.execute(text("ALTER TABLE compartment DROP COLUMN low_stock"))
+        connection.execute(text(
+            "ALTER TABLE compartment ADD COLUMN low_stock BOOLEAN "
+            f"GENERATED ALWAYS AS (number_of_medicines < {LOW_STOCK_THRESHOLD}) VIRTUAL"
+        ))
+
+
+async def create_db_and_tables():
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+        await conn.run_sync(migrate_low_stock_column)
+        await conn.run_sync(create_missing_indexes)
+        await conn.run_sync(drop_replaced_indexes)
+
+
+async def get_session():
+    async with AsyncSessionLocal() as session:
         yield session
 
 
-SessionDep = Annotated[Session, Depends(get_session)]
+SessionDep = Annotated[AsyncSession, Depends(get_session)]
+
+
+async def compartments_etag(if_none_match: Annotated[Optional[str], Header()] = None) -> str:
+    """
+    Answers 304 straight away when the client already has the current
+    version of the compartment list, before any session is opened.
+    """
+    etag = f'W/"{_compartments_boot_id}-{_compartments_version}"'
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        raise HTTPException(status_code=304, headers={"ETag": etag})
+    return etag
+
 
-app = FastAPI()
+CompartmentsETag = Annotated[str, Depends(compartments_etag)]
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await create_db_and_tables()
+    # Opening a session here also warms up the first pooled connection
+    async with AsyncSessionLocal() as session:
+        await load_compartment_cache(session)
+    yield
+    await engine.dispose()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 origins = [
     "http://localhost",           # per test locali
     "http://localhost:4200",      # se usi Angular local
@@ -110,31 +388,30 @@ origins = [
 ]
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],             # oppure usa ["*"] per test ma NON in produzione
+    allow_origins=origins,           # oppure usa ["*"] per test ma NON in produzione
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    max_age=86400,                   # browsers cache the preflight for a day
 )
-
-
-@app.on_event("startup")
-def on_startup():
-    create_db_and_tables()
+# The compartment and log lists are repetitive JSON and compress well
+app.add_middleware(GZipMiddleware, minimum_size=500)
 
 
 # API Endpoints
+#
+# Every endpoint and dependency is `async def` on purpose: database work goes
+# through aiosqlite, so handlers never take a slot in Starlette's 40-thread
+# pool and concurrency is bounded by the connection pool (pool_size) instead.
+# Don't add plain `def` endpoints or dependencies here, FastAPI would run
+# those in the threadpool.
 
 @app.post("/compartments/createcompartment", response_model=CompartmentPublic)
-def create_compartment(compartment: CompartmentCreate, session: Session = Depends(get_session)):
+async def create_compartment(compartment: CompartmentCreate, session: AsyncSession = Depends(get_session)):
     """
     Ensure that if `to_be_repeated` is False, `time_if_not_repeated` is required.
-    Validate that `compartment_number` is 1, 2, or 3.    """
-    if compartment.compartment_number not in [1, 2, 3]:
-        raise HTTPException(
-            status_code=400,
-            detail="compartment_number must be 1, 2, or 3."
-        )
-    
+    `compartment_number` (1, 2, or 3) is already checked by the model.
+    """
     if not compartment.to_be_repeated and not compartment.time_if_not_repeated:
         raise HTTPException(
             status_code=400,
@@ -149,49 +426,38 @@ def create_compartment(compartment: CompartmentCreate, session: Session = Depend
 
     db_compartment = Compartment.model_validate(compartment)
     session.add(db_compartment)
-    session.commit()
-    session.refresh(db_compartment)
+    await session.commit()
+    invalidate_compartment_cache()
     return db_compartment
 
 
 @app.get("/compartments/", response_model=List[CompartmentPublic])
-def get_compartments(
-    session: Session = Depends(get_session),
+async def get_compartments(
+    etag: CompartmentsETag,
+    session: AsyncSession = Depends(get_session),
     offset: int = 0,
     limit: int = Query(100, le=100)
 ):
-    compartments = session.exec(select(Compartment).offset(offset).limit(limit)).all()
-    return compartments
+    return await cached_rows_response(
+        session, ("compartments", offset, limit), _compartment_rows.offset(offset).limit(limit), etag=etag
+    )
 
 
 @app.get("/compartments/{compartment_number}", response_model=List[CompartmentPublic])
-def get_compartments_by_number(compartment_number: int, session: Session = Depends(get_session)):
+async def get_compartments_by_number(compartment_number: CompartmentNum, etag: CompartmentsETag, session: AsyncSession = Depends(get_session)):
     """
     Get all medicines stored in a specific compartment (1, 2, or 3).
     """
-    if compartment_number not in [1, 2, 3]:
-        raise HTTPException(
-            status_code=400,
-            detail="compartment_number must be 1, 2, or 3."
-        )
-
-    compartments = session.exec(select(Compartment).where(Compartment.compartment_number == compartment_number)).all()
-    return compartments
+    return await cached_rows_response(
+        session, ("by_number", compartment_number), _rows_by_num, {"n": compartment_number}, etag
+    )
 
 @app.post("/compartments/bulk-create", response_model=List[CompartmentPublic])
-def create_multiple_compartments(
+async def create_multiple_compartments(
     compartments: List[CompartmentCreate] = Body(...),
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_session)
 ):
-    created_compartments = []
-
     for compartment in compartments:
-        if compartment.compartment_number not in [1, 2, 3]:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Invalid compartment_number: {compartment.compartment_number}. Must be 1, 2, or 3."
-            )
-        
         if not compartment.to_be_repeated and not compartment.time_if_not_repeated:
             raise HTTPException(
                 status_code=400,
@@ -204,85 +470,73 @@ def create_multiple_compartments(
                 detail=f"time_if_not_repeated must be None for repeated medicine in compartment {compartment.compartment_number}."
             )
 
-        db_compartment = Compartment.model_validate(compartment)
-        session.add(db_compartment)
-        created_compartments.append(db_compartment)
-
-    session.commit()
-
-    for comp in created_compartments:
-        session.refresh(comp)
+    # The ids come back from a single INSERT ... RETURNING and the session
+    # doesn't expire on commit, so there is nothing to refresh afterwards
+    created_compartments = [Compartment.model_validate(c) for c in compartments]
+    session.add_all(created_compartments)
+    await session.commit()
+    invalidate_compartment_cache()
 
     return created_compartments
 
 @app.patch("/compartments/updatecompartment/{compartment_id}", response_model=CompartmentPublic)
-def update_compartment(compartment_id: int, compartment_update: CompartmentUpdate, session: Session = Depends(get_session)):
-    compartment = session.get(Compartment, compartment_id)
-    if not compartment:
-        raise HTTPException(status_code=404, detail="Compartment not found")
-
+async def update_compartment(compartment_id: int, compartment_update: CompartmentUpdate, session: AsyncSession = Depends(get_session)):
     update_data = compartment_update.model_dump(exclude_unset=True)
 
-    # Validate compartment_number if it's being updated
-    if "compartment_number" in update_data and update_data["compartment_number"] not in [1, 2, 3]:
-        raise HTTPException(
-            status_code=400,
-            detail="compartment_number must be 1, 2, or 3."
+    # Apply the patch with a single UPDATE ... RETURNING instead of
+    # loading the row first
+    if update_data:
+        result = await session.exec(
+            update(Compartment)
+            .where(Compartment.id == compartment_id)
+            .values(**update_data)
+            .returning(Compartment)
+            .options(raiseload("*"))
         )
+        compartment = result.scalars().first()
+    else:
+        compartment = await session.get(Compartment, compartment_id, options=[raiseload("*")])
 
-    for key, value in update_data.items():
-        setattr(compartment, key, value)
+    if not compartment:
+        raise HTTPException(status_code=404, detail="Compartment not found")
 
-    session.add(compartment)
-    session.commit()
-    session.refresh(compartment)
+    await session.commit()
+    invalidate_compartment_cache()
     return compartment
 
 
 
 @app.delete("/compartments/{compartment_number}/{medicine_name}")
-def delete_medicine_from_compartment(compartment_number: int, medicine_name: str, session: Session = Depends(get_session)):
+async def delete_medicine_from_compartment(compartment_number: CompartmentNum, medicine_name: str, session: AsyncSession = Depends(get_session)):
     """
     Deletes all entries of a specific medicine from a given compartment.
     """
-    # Validate compartment_number
-    if compartment_number not in [1, 2, 3]:
-        raise HTTPException(
-            status_code=400,
-            detail="compartment_number must be 1, 2, or 3."
-        )
-
-    # Find the medicine in the specified compartment
-    compartments = session.exec(
-        select(Compartment).where(
-            (Compartment.compartment_number == compartment_number) &
-            (Compartment.medicine_name == medicine_name)
-        )
-    ).all()
+    # Delete all matching records in a single statement
+    result = await session.exec(
+        _stmt_delete_by_num_and_name, params={"n": compartment_number, "name": medicine_name}
+    )
 
-    if not compartments:
+    if not result.rowcount:
         raise HTTPException(
             status_code=404,
             detail=f"No medicine named '{medicine_name}' found in compartment {compartment_number}."
         )
 
-    # Delete all matching records
-    for compartment in compartments:
-        session.delete(compartment)
-    
-    session.commit()
+    await session.commit()
+    invalidate_compartment_cache()
     
     return {
         "message": f"All entries of '{medicine_name}' have been removed from compartment {compartment_number}."
     }
 
 @app.delete("/compartments/")
-def delete_all_compartments(session: Session = Depends(get_session)):
+async def delete_all_compartments(session: AsyncSession = Depends(get_session)):
     """
     Deletes all compartments from the database.
     """
-    session.exec(select(Compartment).delete())
-    session.commit()
+    await session.exec(delete(Compartment))
+    await session.commit()
+    invalidate_compartment_cache()
     return {"message": "All compartments have been deleted"}
 
 
@@ -292,20 +546,15 @@ def delete_all_compartments(session: Session = Depends(get_session)):
 ###################### Take medicine ######################
 ###########################################################
 @app.patch("/compartments/{compartment_number}/mark-taken", response_model=CompartmentPublic)
-def mark_medicine_taken(compartment_number: int, session: Session = Depends(get_session)):
+async def mark_medicine_taken(compartment_number: CompartmentNum, session: AsyncSession = Depends(get_session)):
     """
     Marks the medicine in the given `compartment_number` as taken.
     """
-    if compartment_number not in [1, 2, 3]:
-        raise HTTPException(
-            status_code=400,
-            detail="compartment_number must be 1, 2, or 3."
-        )
-
-    # Find the only medicine in the compartment
-    compartment = session.exec(
-        select(Compartment).where(Compartment.compartment_number == compartment_number)
-    ).first()
+    # Mark the medicine in the compartment as taken in a single UPDATE ... RETURNING
+    result = await session.exec(
+        _stmt_mark_taken, params={"n": compartment_number, "now": datetime.now(timezone.utc)}
+    )
+    compartment = result.scalars().first()
 
     if not compartment:
         raise HTTPException(
@@ -313,134 +562,150 @@ def mark_medicine_taken(compartment_number: int, session: Session = Depends(get_
             detail=f"No medicine found in compartment {compartment_number}."
         )
 
-    # Mark it as taken
-    compartment.taken = True
-    session.add(compartment)
-    session.commit()
-    session.refresh(compartment)
+    await session.commit()
+    invalidate_compartment_cache()
 
     return compartment
 
 
 @app.patch("/compartments/{compartment_number}/unmark-taken", response_model=CompartmentPublic)
-def unmark_medicine_taken(compartment_number: int, session: Session = Depends(get_session)):
+async def unmark_medicine_taken(compartment_number: CompartmentNum, session: AsyncSession = Depends(get_session)):
     """
     Unmarks the medicine in the given compartment (set taken = False).
     """
-    compartment = session.exec(
-        select(Compartment).where(Compartment.compartment_number == compartment_number)
-    ).first()
+    result = await session.exec(_stmt_unmark_taken, params={"n": compartment_number})
+    compartment = result.scalars().first()
     
     if not compartment :
         raise HTTPException(status_code=404, detail="No medicine found in this compartment")
 
-    compartment.taken = False
-    compartment.taken_at = None
-    session.add(compartment)
-    session.commit()
-    session.refresh(compartment)
+    await session.commit()
+    invalidate_compartment_cache()
     return compartment
 
 
 @app.get("/compartments/{compartment_number}/taken", response_model=List[CompartmentPublic])
-def get_taken_medicines(compartment_number: int, session: Session = Depends(get_session)):
+async def get_taken_medicines(compartment_number: CompartmentNum, etag: CompartmentsETag, session: AsyncSession = Depends(get_session)):
     """
     Retrieves all medicines in the given compartment that have been taken (taken=True).
     """
-    if compartment_number not in [1, 2, 3]:
-        raise HTTPException(
-            status_code=400,
-            detail="compartment_number must be 1, 2, or 3."
-        )
-
-    medicines = session.exec(
-        select(Compartment).where(
-            (Compartment.compartment_number == compartment_number) &
-            (Compartment.taken == True)
-        )
-    ).all()
-
-    return medicines
+    return await cached_rows_response(
+        session, ("taken", compartment_number), _rows_taken, {"n": compartment_number}, etag
+    )
 
 
 @app.get("/compartments/{compartment_number}/pending", response_model=List[CompartmentPublic])
-def get_pending_medicines(compartment_number: int, session: Session = Depends(get_session)):
+async def get_pending_medicines(compartment_number: CompartmentNum, etag: CompartmentsETag, session: AsyncSession = Depends(get_session)):
     """
     Retrieves all medicines in the given compartment that are still pending (taken=False).
     """
-    if compartment_number not in [1, 2, 3]:
-        raise HTTPException(
-            status_code=400,
-            detail="compartment_number must be 1, 2, or 3."
-        )
-
-    medicines = session.exec(
-        select(Compartment).where(
-            (Compartment.compartment_number == compartment_number) &
-            (Compartment.taken == False)
-        )
-    ).all()
-
-    return medicines
+    return await cached_rows_response(
+        session, ("pending", compartment_number), _rows_pending, {"n": compartment_number}, etag
+    )
 
 #################################################################
 ###################### Adafruit stuff ###########################
 #################################################################
 @app.post("/adafruit-taken-webhook/")
-def pill_taken_webhook(data: List[AdafruitData], session: Session = Depends(get_session)):
+async def pill_taken_webhook(data: List[AdafruitData], session: AsyncSession = Depends(get_session)):
+    # Resolve the feeds first so all missing ids are looked up in one query
+    taken_entries = []
     for entry in data:
-        feed = entry.feed_name.lower()
-
-        feed_map = {
-            "comp1-taken": 1,
-            "comp2-taken": 2,
-            "comp3-taken": 3
-        }
-        comp_num = feed_map.get(feed)
-        if not comp_num:
+        comp_num = FEED_TO_COMPARTMENT.get(entry.feed_name.lower())
+        if comp_num is None:
             continue  # unknown feed, ignore
-
-        comp = session.exec(
-            select(Compartment).where(Compartment.compartment_number == comp_num)
-        ).first()
-
-        if not comp:
-            continue
-
         if entry.value.strip() == "1":
-            comp.number_of_medicines -= 1
-            comp.number_of_medicines = max(comp.number_of_medicines, 0)  # prevent negatives
-            comp.taken = True
-            comp.taken_at = parser.isoparse(entry.created_at)
-            comp.low_stock = comp.number_of_medicines < 4
-            
-            log = MedicineLog(
+            taken_entries.append((comp_num, entry))
+
+    if not taken_entries:
+        return {"message": "No valid update processed"}
+
+    numbers = {comp_num for comp_num, _ in taken_entries}
+    ids = {n: _compartment_cache[n] for n in numbers if n in _compartment_cache}
+    missing = numbers - ids.keys()
+    results = []
+    logs = []
+
+    # One transaction (and one fsync) for the whole payload
+    async with session.begin():
+        if missing:
+            ids.update(await load_compartment_cache(session, missing))
+
+        for comp_num, entry in taken_entries:
+            comp_id = ids.get(comp_num)
+            if comp_id is None:
+                continue
+
+            comp = (await session.exec(_stmt_take_pill, params={"comp_id": comp_id, "ts": entry.created_at})).first()
+            if comp is None:
+                # The cached row is gone, the compartment may still have others
+                _compartment_cache.pop(comp_num, None)
+                comp_id = ids[comp_num] = (await load_compartment_cache(session, {comp_num})).get(comp_num)
+                if comp_id is not None:
+                    comp = (await session.exec(
+                        _stmt_take_pill, params={"comp_id": comp_id, "ts": entry.created_at}
+                    )).first()
+            if comp is None:
+                continue
+
+            logs.append(MedicineLog(
                 compartment_number=comp.compartment_number,
                 medicine_name=comp.medicine_name,
-                taken_at=comp.taken_at,
+                taken_at=entry.created_at,
                 action="taken"
-            )
-
-            session.add(log)
-            session.add(comp)
-            session.commit()
-            session.refresh(comp)
-
-            return {
+            ))
+            results.append({
                 "message": f"Compartment {comp_num} updated",
                 "new_count": comp.number_of_medicines,
                 "low_stock": comp.low_stock
-            }
+            })
+
+        session.add_all(logs)
 
-    return {"message": "No valid update processed"}
+    if not results:
+        return {"message": "No valid update processed"}
+
+    bump_compartments_version()
+
+    return {
+        "message": f"{len(results)} update(s) processed",
+        "count": len(results),
+        "processed": results
+    }
 
 
 @app.get("/logs/", response_model=List[MedicineLog])
-def get_all_logs(session: Session = Depends(get_session)):
-    return session.exec(select(MedicineLog).order_by(MedicineLog.taken_at.desc())).all()
+async def get_all_logs(
+    session: AsyncSession = Depends(get_session),
+    before: Optional[datetime] = None,
+    before_id: Optional[int] = None,
+    limit: int = Query(100, ge=1, le=500)
+):
+    """
+    Most recent logs first. Pass the taken_at and id of the last log received
+    as `before` and `before_id` to get the next page.
+    """
+    if before is None:
+        if before_id is not None:
+            raise HTTPException(status_code=400, detail="before_id requires before.")
+        return await cached_rows_response(session, ("logs", limit), _log_rows, params={"limit": limit})
+
+    # Each cursor page is fetched about once, so it stays out of the response
+    # cache instead of evicting the hot first-page and compartment entries
+    if before_id is None:
+        body = await render_rows(session, _log_rows_before, {"limit": limit, "before": before})
+    else:
+        body = await render_rows(
+            session, _log_rows_before_id, {"limit": limit, "before": before, "before_id": before_id}
+        )
+    return Response(content=body, media_type="application/json")
 
 @app.get("/logs/by-day/{date}", response_model=List[MedicineLog])
-def get_logs_by_day(date: str, session: Session = Depends(get_session)):
+async def get_logs_by_day(
+    date: str,
+    session: AsyncSession = Depends(get_session),
+    limit: int = Query(500, ge=1, le=500)
+):
     try:
         day_start = datetime.fromisoformat(date)
     except:
@@ -448,43 +713,32 @@ def get_logs_by_day(date: str, session: Session = Depends(get_session)):
 
     day_end = day_start + timedelta(days=1)
 
-    logs = session.exec(
-        select(MedicineLog).where(
-            MedicineLog.taken_at >= day_start,
-            MedicineLog.taken_at < day_end
-        ).order_by(MedicineLog.taken_at)
-    ).all()
+    logs = (await session.exec(
+        _stmt_logs_between, params={"start": day_start, "end": day_end, "limit": limit}
+    )).all()
 
     return logs
 
 @app.post("/compartments/{compartment_number}/refill")
-def refill_medicine(compartment_number : int, refill: RefillRequest, session : Session = Depends(get_session)):
-    compartment = session.exec(select(Compartment).where(Compartment.compartment_number==compartment_number)).first()
+async def refill_medicine(compartment_number: CompartmentNum, refill: RefillRequest, session : AsyncSession = Depends(get_session)):
+    # Add in SQL so a concurrent webhook decrement isn't overwritten
+    result = await session.exec(_stmt_refill, params={"n": compartment_number, "amount": refill.amount})
+    current_total = result.scalars().first()
 
-    if compartment_number not in [1, 2, 3]:
-        raise HTTPException(
-            status_code=400,
-            detail="Invalid compartment number. Only 1, 2, or 3 are allowed."
-        )
-    
-    if not compartment:
+    if current_total is None:
         raise HTTPException(status_code=404, detail="Compartment not found")
-    
-    compartment.number_of_medicines += refill.amount  #if i want just the value, can simply remove the +
-    compartment.taken = False
-    compartment.low_stock = compartment.number_of_medicines < 4
-    session.add(compartment)
-    session.commit()
-    session.refresh(compartment)
+
+    await session.commit()
+    invalidate_compartment_cache()
 
     return {
         "message": f"Refilled compartment {compartment_number} with {refill.amount} units.",
-        "current_total": compartment.number_of_medicines
+        "current_total": current_total
     }
 
 
 # @app.post("/adafruit-webhook/")
-# def receive_adafruit_data(data: List[AdafruitData], session: Session = Depends(get_session)):
+# async def receive_adafruit_data(data: List[AdafruitData], session: AsyncSession = Depends(get_session)):
 #     """
 #     Receives data from Adafruit IO, determines which compartment is activated,
 #     and marks the medicine in that compartment as taken.
@@ -503,17 +757,14 @@ def refill_medicine(compartment_number : int, refill: RefillRequest, session : S
 #             continue  # Ignore feeds that don't match compartment names
 
 #         # Find the medicine in the correct compartment
-#         compartment = session.exec(
+#         compartment = (await session.exec(
 #             select(Compartment).where(Compartment.compartment_number == compartment_number)
-#         ).first()
+#         )).first()
 
 #         if not compartment:
 #             return {"message": f"No medicine found in compartment {compartment_number}."}
 
-#         try :
-#             taken_time = parser.isoparse(entry.created_at)
-#         except Exception:
-#             taken_time = datetime.utcnow() #fallback
+#         taken_time = entry.created_at  # already parsed by AdafruitData
 
 #         try:
 #             remaining_pills = int(entry.value)
@@ -525,12 +776,10 @@ def refill_medicine(compartment_number : int, refill: RefillRequest, session : S
 #         compartment.taken_at = taken_time
 #         compartment.number_of_medicines = remaining_pills
         
-#         compartment.low_stock = remaining_pills < 4
 
 
-#         session.add(compartment)
-#         session.commit()
-#         session.refresh(compartment)
+#         await session.commit()
+#         invalidate_compartment_cache()
 
 #         response = {
 #             "message": f"Medicine in compartment {compartment_number} marked as taken.",
@@ -559,7 +808,7 @@ def refill_medicine(compartment_number : int, refill: RefillRequest, session : S
 #     session.commit()
 
 #     def str_to_time(t: str) -> Optional[time]:
-#         return datetime.strptime(t, "%H:%M:%S").time() if t else None
+#         return time.fromisoformat(t) if t else None
 
 #     now = datetime.utcnow()
 
@@ -612,24 +861,16 @@ def refill_medicine(compartment_number : int, refill: RefillRequest, session : S
 
 
 # @app.post("/adafruit-taken-webhook/")
-# def pill_taken_from_adafruit(data: List[AdafruitData], session: Session = Depends(get_session)):
+# async def pill_taken_from_adafruit(data: List[AdafruitData], session: AsyncSession = Depends(get_session)):
 #     for entry in data:
-#         feed_name = entry.feed_name.lower()
-
 #         # Map feed name to compartment number (taken feeds only)
-#         feed_to_compartment = {
-#             "comp1-taken": 1,
-#             "comp2-taken": 2,
-#             "comp3-taken": 3
-#         }
-
-#         compartment_number = feed_to_compartment.get(feed_name)
-#         if not compartment_number:
+#         compartment_number = FEED_TO_COMPARTMENT.get(entry.feed_name.lower())
+#         if compartment_number is None:
 #             continue
 
-#         compartment = session.exec(
+#         compartment = (await session.exec(
 #             select(Compartment).where(Compartment.compartment_number == compartment_number)
-#         ).first()
+#         )).first()
 
 #         if not compartment:
 #             return {"message": f"No medicine found in compartment {compartment_number}."}
@@ -639,19 +880,14 @@ def refill_medicine(compartment_number : int, refill: RefillRequest, session : S
 #         except ValueError:
 #             return {"error": f"Invalid value: {entry.value}"}
 
-#         try:
-#             taken_time = parser.isoparse(entry.created_at)
-#         except Exception:
-#             taken_time = datetime.utcnow()
+#         taken_time = entry.created_at  # already parsed by AdafruitData
 
 #         compartment.taken = True
 #         compartment.taken_at = taken_time
 #         compartment.number_of_medicines = remaining
-#         compartment.low_stock = remaining < 4
 
-#         session.add(compartment)
-#         session.commit()
-#         session.refresh(compartment)
+#         await session.commit()
+#         invalidate_compartment_cache()
 
 #         return {
 #             "message": f"Marked compartment {compartment_number} as taken.",